@@ -11,9 +11,13 @@ import paho.mqtt.client as mqtt
 BROKER = "localhost"
 PORT = 1883
 TOPIC = "wind/turbine/data/T101"
+QOS = 1  # QoS 0 ne serait ni acquitté ni conservé pour les sessions persistantes
 
 client = mqtt.Client()
 client.connect(BROKER, PORT, 60)
+# Boucle réseau en arrière-plan: lit les PUBACK (QoS 1) et libère la fenêtre
+# des messages en vol, sinon paho bloque après max_inflight_messages envois
+client.loop_start()
 
 # ======================
 # STATISTIQUES
@@ -85,7 +89,7 @@ row = 0
 while True:
     message = generate_message(row)
     pretty_json = json.dumps(message,indent=4)
-    client.publish(TOPIC, pretty_json)
+    client.publish(TOPIC, pretty_json, qos=QOS)
     
     print(pretty_json)
 
@@ -1,7 +1,18 @@
+import cProfile
+import io
 import json
+import math
+import os
+import pstats
+import signal
+import socket
+import socketserver
 import time
+import tracemalloc
 from datetime import datetime
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import redis
 from pymongo import MongoClient, ASCENDING
 from typing import Dict, Optional
@@ -19,6 +30,31 @@ MQTT_TOPICS = [
     "wind/turbine/data/T103"
 ]
 
+# Abonnement partagé MQTT 5: les collecteurs d'un même groupe se répartissent
+# les messages ($share/<groupe>/<filtre>). None = abonnement classique.
+MQTT_SHARED_GROUP = "collectors"
+MQTT_SHARED_TOPIC = "wind/turbine/data/+"
+# QoS effective = min(QoS de publication, QoS d'abonnement): les générateurs
+# publient aussi en QoS 1, sinon le broker ne conserve rien pendant une
+# déconnexion (les messages QoS 0 ne sont pas mis en file pour une session).
+MQTT_QOS = 1
+
+# Session persistante: client id stable et expiration de session côté broker.
+# L'id d'instance doit être unique et stable pour chaque processus collecteur
+# (COLLECTOR_INSTANCE_ID=1, 2, ...): deux connexions avec le même client id
+# se déconnectent mutuellement au lieu de se partager les messages.
+MQTT_CLIENT_ID_PREFIX = "wind-collector"
+MQTT_INSTANCE_ID = os.environ.get("COLLECTOR_INSTANCE_ID")  # None = "0" + avertissement
+MQTT_SESSION_EXPIRY = 3600  # secondes, 0 = session non persistante
+MQTT_KEEPALIVE = 60
+# Délai de reconnexion: doublé à chaque échec, plafonné (secondes)
+MQTT_RECONNECT_MIN_DELAY = 1
+MQTT_RECONNECT_MAX_DELAY = 120
+
+# Nombre maximal de messages QoS > 0 non acquittés que le broker envoie au
+# collecteur (propriété MQTT 5 ReceiveMaximum du CONNECT)
+MQTT_RECEIVE_MAXIMUM = 100
+
 # Redis Configuration (Nœud 2)
 REDIS_HOST = "localhost"
 REDIS_PORT = 6379
@@ -33,6 +69,226 @@ MONGO_URI = "mongodb://localhost:27017/"
 MONGO_DB = "wind_farm"
 MONGO_COLLECTION = "turbine_data"
 
+# Profilage (opt-in par nœud). Déclenché par SIGUSR1 ou par l'endpoint local:
+#   echo "node1 30" | nc 127.0.0.1 8765
+PROFILE_NODE_1 = False
+PROFILE_NODE_2 = False
+PROFILE_WINDOW = 30  # durée par défaut de la fenêtre de profilage (secondes)
+PROFILE_MAX_WINDOW = 10 * PROFILE_WINDOW  # durée maximale acceptée (secondes)
+PROFILE_OUTPUT_DIR = "profiles"
+PROFILE_TOP_N = 25
+PROFILE_CONTROL_PORT = 8765  # None = pas d'endpoint de contrôle
+PROFILE_POLL_INTERVAL = 1.0  # attente max des boucles des nœuds (échéance du profilage)
+PROFILE_CONTROL_TIMEOUT = 5  # secondes d'attente de la ligne de commande sur l'endpoint
+
+
+# PROFILAGE DES NŒUDS
+# cProfile + tracemalloc sur une fenêtre de temps, à la demande
+
+PROFILERS = {}
+# Une seule fenêtre à la fois dans le processus: depuis Python 3.12, cProfile
+# repose sur sys.monitoring (global à l'interpréteur) et un second
+# Profile().enable() concurrent lève ValueError.
+_profiling_lock = threading.Lock()
+_active_profiler = None
+
+
+def valid_profile_duration(duration: Optional[float]) -> bool:
+    """Durée absente (défaut) ou finie, > 0 et <= PROFILE_MAX_WINDOW"""
+    return duration is None or (math.isfinite(duration) and 0 < duration <= PROFILE_MAX_WINDOW)
+
+
+class NodeProfiler:
+    """
+    Profileur d'un nœud. La demande (signal, endpoint) lève un drapeau et le
+    thread du nœud démarre et arrête lui-même le profilage dans tick(), appelé
+    à chaque message et à chaque tour de sa boucle d'attente (timeout), donc
+    l'échéance est respectée même sans trafic.
+    Avant Python 3.12 cProfile ne suit que le thread du nœud; à partir de 3.12
+    il voit tous les threads de l'interpréteur pendant la fenêtre.
+    Profilage désactivé = deux tests d'attribut par tick.
+    """
+    
+    def __init__(self, node_name: str, enabled: bool):
+        self.node_name = node_name
+        self.enabled = enabled
+        self.lock = threading.RLock()
+        self.active = False
+        self.pending = False
+        self.duration = PROFILE_WINDOW
+        self.deadline = 0.0
+        self.profile = None
+        self.started_tracemalloc = False
+        self.messages = 0
+        PROFILERS[node_name] = self
+    
+    def request(self, duration: Optional[float] = None) -> bool:
+        """Demande une fenêtre de profilage (appelable depuis n'importe quel thread)"""
+        if not self.enabled:
+            print(f"[PROFIL] Profilage désactivé pour {self.node_name}")
+            return False
+        if not valid_profile_duration(duration):
+            print(f"[PROFIL] Durée invalide pour {self.node_name}: {duration} "
+                  f"(attendu: 0 < durée <= {PROFILE_MAX_WINDOW}s)")
+            return False
+        with self.lock:
+            if self.active or self.pending:
+                print(f"[PROFIL] Profilage déjà en cours pour {self.node_name}")
+                return False
+            self.duration = duration or PROFILE_WINDOW
+            self.pending = True
+        print(f"[PROFIL] Fenêtre de {self.duration}s demandée pour {self.node_name}")
+        return True
+    
+    def tick(self, received: bool = True):
+        """
+        Point de contrôle appelé par le thread du nœud.
+        received: un message a été reçu depuis le dernier tick
+        """
+        if not (self.pending or self.active):
+            return
+        try:
+            with self.lock:
+                if self.pending:
+                    self._start()
+                if self.active:
+                    if received:
+                        self.messages += 1
+                    if time.monotonic() >= self.deadline:
+                        self._stop()
+        except Exception as e:
+            print(f"[PROFIL] Erreur de profilage {self.node_name}: {e}")
+    
+    def _start(self):
+        """Démarre la fenêtre si aucune autre n'est active (sinon reste en attente)"""
+        global _active_profiler
+        with _profiling_lock:
+            if _active_profiler is not None:
+                return
+            _active_profiler = self
+        self.pending = False
+        try:
+            self.started_tracemalloc = not tracemalloc.is_tracing()
+            if self.started_tracemalloc:
+                tracemalloc.start()
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        except Exception:
+            self._release()
+            raise
+        self.messages = 0
+        self.deadline = time.monotonic() + self.duration
+        self.active = True
+        print(f"[PROFIL] Profilage de {self.node_name} démarré")
+    
+    def _stop(self):
+        self.profile.disable()
+        self.active = False
+        try:
+            self.dump(tracemalloc.take_snapshot())
+        except Exception as e:
+            print(f"[PROFIL] Erreur d'écriture du profil {self.node_name}: {e}")
+        finally:
+            self._release()
+    
+    def _release(self):
+        """Arrête tracemalloc si ce profileur l'a démarré et libère la fenêtre"""
+        global _active_profiler
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+        self.profile = None
+        with _profiling_lock:
+            _active_profiler = None
+    
+    def dump(self, snapshot):
+        """Écrit le profil brut (.prof) et un résumé des chemins chauds (.txt)"""
+        os.makedirs(PROFILE_OUTPUT_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        base = os.path.join(PROFILE_OUTPUT_DIR, f"{self.node_name}_{stamp}")
+        self.profile.dump_stats(f"{base}.prof")
+        
+        report = io.StringIO()
+        report.write(f"Nœud: {self.node_name} - fenêtre: {self.duration}s - "
+                     f"messages: {self.messages}\n\n")
+        stats = pstats.Stats(self.profile, stream=report).strip_dirs()
+        for sort_key in ("tottime", "cumulative"):
+            report.write(f"=== Top {PROFILE_TOP_N} fonctions par {sort_key} ===\n")
+            stats.sort_stats(sort_key).print_stats(PROFILE_TOP_N)
+        
+        report.write(f"=== Top {PROFILE_TOP_N} allocations (tracemalloc) ===\n")
+        for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]:
+            report.write(f"{stat}\n")
+        
+        with open(f"{base}.txt", "w", encoding="utf-8") as f:
+            f.write(report.getvalue())
+        print(f"[PROFIL] Profil de {self.node_name} écrit dans {base}.prof / {base}.txt")
+
+
+def request_profiling(node_name: Optional[str] = None, duration: Optional[float] = None) -> bool:
+    """
+    Demande une fenêtre de profilage pour un nœud (ou tous si node_name est None).
+    Les fenêtres de plusieurs nœuds s'exécutent l'une après l'autre.
+    Retourne True si au moins une demande a été acceptée.
+    """
+    if node_name is None:
+        targets = list(PROFILERS.values())
+    elif node_name in PROFILERS:
+        targets = [PROFILERS[node_name]]
+    else:
+        print(f"[PROFIL] Nœud inconnu: {node_name}")
+        return False
+    accepted = [profiler.request(duration) for profiler in targets]
+    return any(accepted)
+
+
+class ProfileControlHandler(socketserver.StreamRequestHandler):
+    """Endpoint local: une ligne '<nœud|all> [durée]' par connexion"""
+    
+    timeout = PROFILE_CONTROL_TIMEOUT
+    
+    def handle(self):
+        try:
+            parts = self.rfile.readline().decode().split()
+        except socket.timeout:
+            return
+        try:
+            node_name = parts[0] if parts and parts[0] != "all" else None
+            duration = float(parts[1]) if len(parts) > 1 else None
+        except ValueError:
+            duration = math.nan
+        if not valid_profile_duration(duration):
+            self.wfile.write(f"usage: <node1|node2|all> [secondes, 0 < duree <= {PROFILE_MAX_WINDOW}]\n".encode())
+            return
+        if request_profiling(node_name, duration):
+            self.wfile.write(b"ok\n")
+        else:
+            self.wfile.write(b"refused: noeud inconnu, desactive ou deja en cours\n")
+
+
+class ProfileControlServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+def install_profiling_triggers():
+    """
+    Installe le signal SIGUSR1 et l'endpoint local (à appeler depuis le thread
+    principal). Rien n'est installé si aucun nœud n'a le profilage activé.
+    """
+    if not (PROFILE_NODE_1 or PROFILE_NODE_2):
+        return
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: request_profiling())
+        print(f"[PROFIL] SIGUSR1 -> profilage (pid {os.getpid()})")
+    if PROFILE_CONTROL_PORT is not None:
+        try:
+            server = ProfileControlServer(("127.0.0.1", PROFILE_CONTROL_PORT), ProfileControlHandler)
+        except OSError as e:
+            print(f"[PROFIL] Endpoint de contrôle indisponible sur le port {PROFILE_CONTROL_PORT}: {e}")
+            return
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"[PROFIL] Endpoint de contrôle sur 127.0.0.1:{PROFILE_CONTROL_PORT}")
+
 
 # NŒUD 1: DATA COLLECTOR & CLEANER
 # Ce nœud écoute MQTT, nettoie les données et les publie vers Redis
@@ -40,8 +296,25 @@ MONGO_COLLECTION = "turbine_data"
 class DataCollectorCleaner:
     """Nœud 1: Collecte et nettoyage des données"""
     
-    def __init__(self):
-        self.mqtt_client = mqtt.Client()
+    def __init__(self, instance_id: Optional[str] = MQTT_INSTANCE_ID, shared_group: Optional[str] = MQTT_SHARED_GROUP,
+                 qos: int = MQTT_QOS, session_expiry: int = MQTT_SESSION_EXPIRY):
+        """
+        instance_id: identifiant de l'instance, doit rester le même entre deux
+        redémarrages pour retrouver la session persistante sur le broker
+        shared_group: groupe d'abonnement partagé (None = chaque instance reçoit tout)
+        """
+        if instance_id is None:
+            instance_id = "0"
+            if shared_group:
+                print("[NŒUD 1] ATTENTION: COLLECTOR_INSTANCE_ID non défini, id d'instance '0' "
+                      "utilisé. Plusieurs collecteurs sur cet hôte auraient le même client id "
+                      "et se déconnecteraient mutuellement: définissez un id unique par processus.")
+        self.client_id = f"{MQTT_CLIENT_ID_PREFIX}-{socket.gethostname()}-{instance_id}"
+        self.shared_group = shared_group
+        self.qos = qos
+        self.session_expiry = session_expiry
+        self.profiler = NodeProfiler("node1", PROFILE_NODE_1)
+        self.mqtt_client = mqtt.Client(client_id=self.client_id, protocol=mqtt.MQTTv5)
         self.redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
         self.setup_mqtt()
         
@@ -49,13 +322,21 @@ class DataCollectorCleaner:
         """Configure les callbacks MQTT"""
         self.mqtt_client.on_connect = self.on_connect
         self.mqtt_client.on_message = self.on_message
+    
+    def subscription_topics(self):
+        """Retourne les filtres d'abonnement (partagé ou classique)"""
+        if self.shared_group:
+            return [f"$share/{self.shared_group}/{MQTT_SHARED_TOPIC}"]
+        return list(MQTT_TOPICS)
         
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         """Callback de connexion MQTT"""
-        print(f"[NŒUD 1] Connecté au broker MQTT (code: {rc})")
-        for topic in MQTT_TOPICS:
-            client.subscribe(topic)
-            print(f"[NŒUD 1] Abonné au topic: {topic}")
+        session_present = flags.get('session present', 0)
+        print(f"[NŒUD 1] Connecté au broker MQTT en tant que {self.client_id} "
+              f"(code: {rc}, session existante: {bool(session_present)})")
+        for topic in self.subscription_topics():
+            client.subscribe(topic, qos=self.qos)
+            print(f"[NŒUD 1] Abonné au topic: {topic} (QoS {self.qos})")
     
     def clean_data(self, data: Dict) -> Dict:
         """
@@ -81,6 +362,8 @@ class DataCollectorCleaner:
     def on_message(self, client, userdata, msg):
         """Callback de réception de message MQTT"""
         try:
+            self.profiler.tick()
+            
             # Parse le JSON
             raw_data = json.loads(msg.payload.decode())
             turbine_id = raw_data.get('turbine_id')
@@ -102,8 +385,41 @@ class DataCollectorCleaner:
     def start(self):
         """Démarre le nœud collecteur"""
         print("[NŒUD 1] Démarrage du Data Collector & Cleaner...")
-        self.mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        self.mqtt_client.loop_forever()
+        # Session persistante: clean_start=False + SessionExpiryInterval
+        connect_properties = Properties(PacketTypes.CONNECT)
+        connect_properties.SessionExpiryInterval = self.session_expiry
+        connect_properties.ReceiveMaximum = MQTT_RECEIVE_MAXIMUM
+        self.mqtt_client.connect(MQTT_BROKER, MQTT_PORT, MQTT_KEEPALIVE,
+                                 clean_start=self.session_expiry == 0,
+                                 properties=connect_properties)
+        # Boucle avec timeout plutôt que loop_forever(): le profileur vérifie
+        # son échéance même quand aucun message n'arrive
+        reconnect_delay = MQTT_RECONNECT_MIN_DELAY
+        last_reconnect = 0.0
+        while True:
+            rc = self.mqtt_client.loop(timeout=PROFILE_POLL_INTERVAL)
+            self.profiler.tick(received=False)
+            if rc == mqtt.MQTT_ERR_SUCCESS:
+                continue
+            # Backoff exponentiel, remis au minimum après une connexion stable
+            if time.monotonic() - last_reconnect > MQTT_RECONNECT_MAX_DELAY:
+                reconnect_delay = MQTT_RECONNECT_MIN_DELAY
+            print(f"[NŒUD 1] Connexion MQTT perdue (code: {rc}), "
+                  f"reconnexion dans {reconnect_delay}s...")
+            self.wait(reconnect_delay)
+            try:
+                self.mqtt_client.reconnect()
+            except Exception as e:
+                print(f"[NŒUD 1] Erreur de reconnexion: {e}")
+            last_reconnect = time.monotonic()
+            reconnect_delay = min(reconnect_delay * 2, MQTT_RECONNECT_MAX_DELAY)
+    
+    def wait(self, delay: float):
+        """Attend delay secondes en laissant le profileur vérifier son échéance"""
+        end = time.monotonic() + delay
+        while time.monotonic() < end:
+            time.sleep(max(0, min(end - time.monotonic(), PROFILE_POLL_INTERVAL)))
+            self.profiler.tick(received=False)
 
 
 # NŒUD 2: REDIS STREAMING
@@ -119,6 +435,7 @@ class RedisStreamer:
         self.mongo_client = MongoClient(MONGO_URI)
         self.db = self.mongo_client[MONGO_DB]
         self.collection = self.db[MONGO_COLLECTION]
+        self.profiler = NodeProfiler("node2", PROFILE_NODE_2)
         self.setup_indexes()
         
     def setup_indexes(self):
@@ -141,8 +458,12 @@ class RedisStreamer:
     def process_messages(self):
         """Traite les messages Redis et les envoie vers MongoDB (Nœud 3)"""
         print("[NŒUD 2] En écoute des streams Redis...")
-        for message in self.pubsub.listen():
-            if message['type'] == 'message':
+        # get_message() avec timeout plutôt que listen(): le profileur vérifie
+        # son échéance même quand aucun message n'arrive
+        while True:
+            message = self.pubsub.get_message(timeout=PROFILE_POLL_INTERVAL)
+            self.profiler.tick(received=bool(message) and message['type'] == 'message')
+            if message and message['type'] == 'message':
                 try:
                     data = json.loads(message['data'])
                     turbine_id = data.get('turbine_id')
@@ -354,9 +675,9 @@ class QueryEngine:
 # ORCHESTRATION - DÉMARRAGE DES NŒUDS
 # ============================================================================
 
-def start_node_1():
+def start_node_1(instance_id: Optional[str] = MQTT_INSTANCE_ID):
     """Démarre le Nœud 1: Collecteur et Nettoyeur"""
-    collector = DataCollectorCleaner()
+    collector = DataCollectorCleaner(instance_id=instance_id)
     collector.start()
 
 def start_node_2():
@@ -391,11 +712,15 @@ if __name__ == "__main__":
     INSTRUCTIONS:
     1. Assurez-vous que Mosquitto, Redis et MongoDB sont démarrés
     2. Lancez les 3 générateurs de données (T101, T102, T103)
-    3. Lancez ce script
+    3. Lancez ce script (plusieurs collecteurs: COLLECTOR_INSTANCE_ID
+       unique et stable par processus)
     
     Ce script démarre tous les nœuds en threads séparés.
     """)
     
+    # Déclencheurs du profilage (signal / endpoint local)
+    install_profiling_triggers()
+    
     # Créer les threads pour chaque nœud
     thread_node_1 = threading.Thread(target=start_node_1, daemon=True)
     thread_node_2 = threading.Thread(target=start_node_2, daemon=True)